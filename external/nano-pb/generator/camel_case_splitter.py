@@ -1,25 +1,41 @@
+# Cache of split_camel_case() results. Cleared when it reaches
+# CACHE_SIZE entries, which keeps memory bounded for huge schemas.
+CACHE_SIZE = 4096
+_cache = {}
+
 def split_camel_case(input):
+    try:
+        return _cache[input]
+    except KeyError:
+        pass
+
+    result = _split_camel_case(input)
+    if len(_cache) >= CACHE_SIZE:
+        _cache.clear()
+    _cache[input] = result
+    return result
+
+
+def _split_camel_case(input):
     def remove_camel_case(camel_case_input):
-        no_camel_case = ""
         if len(camel_case_input) <= 0:
             return ""
-        no_camel_case += camel_case_input[0].lower()
+        no_camel_case = [camel_case_input[0].lower()]
         for c in camel_case_input[1:]:
             if c.isupper():
-                no_camel_case += "_" + c.lower()
+                no_camel_case.append("_" + c.lower())
             else:
-                no_camel_case += c
-        return no_camel_case
+                no_camel_case.append(c)
+        return "".join(no_camel_case)
 
-    underscore_split = input.split("_")
-    retval = ""
-    for i in underscore_split:
+    retval = []
+    for i in input.split("_"):
         if is_camel_case_name(i):
-            retval += remove_camel_case(i) + "_"
+            retval.append(remove_camel_case(i))
         else:
-            retval += i + "_"
+            retval.append(i)
 
-    return retval[:-1].replace("__", "_")
+    return "_".join(retval).replace("__", "_")
 
 
 def is_camel_case_name(input):
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+from __future__ import unicode_literals
+
+'''Benchmark the phases of nanopb_generator.py on synthetic schemas.
+
+The schemas are built directly as FileDescriptorProtos, so protoc is not
+needed. The real DFU init packet schema (dfu-cc.proto) is also measured
+when protoc is available to compile it.
+'''
+
+import sys
+import os
+import gc
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # Python 2, only times are reported
+
+import nanopb_generator as gen
+
+descriptor = gen.descriptor
+FieldD = descriptor.FieldDescriptorProto
+
+# ---------------------------------------------------------------------------
+#                       Synthetic schema generation
+# ---------------------------------------------------------------------------
+
+class Schema:
+    '''Parameters of a synthetic schema.'''
+    def __init__(self, messages = 100, depth = 2, fields = 10, enums = 4,
+                 enum_values = 16, oneofs = 1, options_lines = 0, files = 1,
+                 reverse = False):
+        self.messages = messages
+        self.depth = depth
+        self.fields = fields
+        self.enums = enums
+        self.enum_values = enum_values
+        self.oneofs = oneofs
+        self.options_lines = options_lines
+        self.files = files
+        self.reverse = reverse
+
+    def __str__(self):
+        return ('%d files x %d msgs, depth %d, %d fields, %d enums x %d values, '
+                '%d oneofs, %d option lines%s' %
+                (self.files, self.messages, self.depth, self.fields, self.enums,
+                 self.enum_values, self.oneofs, self.options_lines,
+                 ', reversed chain' if self.reverse else ''))
+
+def add_field(msg, name, number, type, label = FieldD.LABEL_OPTIONAL,
+              type_name = None, default = None, oneof = None):
+    f = msg.field.add()
+    f.name = name
+    f.number = number
+    f.type = type
+    f.label = label
+    if type_name is not None:
+        f.type_name = type_name
+    if default is not None:
+        f.default_value = default
+    if oneof is not None:
+        f.oneof_index = oneof
+    return f
+
+def make_common_file(schema):
+    '''Enums shared by all the other files, like a common.proto.
+    Every other enum uses short names, to exercise the default value fixups.'''
+    fdesc = descriptor.FileDescriptorProto()
+    fdesc.name = 'bench_common.proto'
+    fdesc.package = 'common'
+    for e in range(schema.enums):
+        enum = fdesc.enum_type.add()
+        enum.name = 'Enum%d' % e
+        if e % 2:
+            enum.options.Extensions[gen.nanopb_pb2.nanopb_enumopt].long_names = False
+        for v in range(schema.enum_values):
+            value = enum.value.add()
+            value.name = 'E%d_VALUE_%d' % (e, v)
+            value.number = v - 1 if e % 3 == 2 else v # Some with negative values
+    return fdesc
+
+def fill_message(msg, schema, path, submsg, options_lines):
+    '''Add the fields of schema to msg, and the matching .options lines.
+    submsg is the index of the message to chain to, or None.'''
+    number = 1
+    for i in range(schema.fields):
+        name = 'f%d' % i
+        kind = i % 6
+        if kind == 0:
+            add_field(msg, name, number, FieldD.TYPE_INT32)
+        elif kind == 1:
+            add_field(msg, name, number, FieldD.TYPE_UINT32, FieldD.LABEL_REPEATED)
+            options_lines.append('%s.%s max_count:8' % (path, name))
+        elif kind == 2:
+            add_field(msg, name, number, FieldD.TYPE_STRING)
+            options_lines.append('%s.%s max_size:32' % (path, name))
+        elif kind == 3:
+            add_field(msg, name, number, FieldD.TYPE_BYTES)
+            options_lines.append('%s.%s max_size:64' % (path, name))
+        elif kind == 4 and schema.enums:
+            e = i % schema.enums
+            add_field(msg, name, number, FieldD.TYPE_ENUM,
+                      type_name = '.common.Enum%d' % e,
+                      default = 'E%d_VALUE_%d' % (e, i % schema.enum_values))
+        elif kind == 5 and submsg is not None:
+            # Submessage chains through the file
+            add_field(msg, name, number, FieldD.TYPE_MESSAGE,
+                      type_name = '.bench.Msg%d' % submsg)
+        else:
+            add_field(msg, name, number, FieldD.TYPE_FIXED64)
+        number += 1
+
+    for o in range(schema.oneofs):
+        msg.oneof_decl.add().name = 'choice%d' % o
+        add_field(msg, 'o%d_int' % o, number, FieldD.TYPE_SINT32, oneof = o)
+        add_field(msg, 'o%d_dbl' % o, number + 1, FieldD.TYPE_DOUBLE, oneof = o)
+        number += 2
+
+def make_file(schema, fileindex):
+    '''Returns (FileDescriptorProto, list of .options lines).'''
+    fdesc = descriptor.FileDescriptorProto()
+    fdesc.name = 'bench%d.proto' % fileindex
+    fdesc.package = 'bench'
+    fdesc.dependency.append('bench_common.proto')
+
+    options_lines = []
+    for m in range(schema.messages):
+        msg = fdesc.message_type.add()
+        msg.name = 'Msg%d' % m
+        path = 'bench.' + msg.name
+
+        # Normally each message contains the previous one. A reversed chain
+        # contains the next one, so every message is declared before the
+        # messages it depends on.
+        if schema.reverse:
+            submsg = m + 1 if m + 1 < schema.messages else None
+        else:
+            submsg = m - 1 if m > 0 else None
+        fill_message(msg, schema, path, submsg, options_lines)
+
+        for d in range(schema.depth):
+            msg = msg.nested_type.add()
+            msg.name = 'Nested%d' % d
+            path += '.' + msg.name
+            fill_message(msg, schema, path, None, options_lines)
+
+    # Pad with patterns that do not match anything, half of them wildcards
+    for i in range(max(0, schema.options_lines - len(options_lines))):
+        if i % 2:
+            options_lines.append('bench.Unused%d.* max_size:8' % i)
+        else:
+            options_lines.append('bench.Unused%d.field max_size:8' % i)
+
+    return fdesc, options_lines
+
+# ---------------------------------------------------------------------------
+#                       Measurement of the phases
+# ---------------------------------------------------------------------------
+
+class Measurement:
+    '''Collects time and peak memory of each phase.'''
+    def __init__(self):
+        self.phases = []
+        self.results = {}
+
+    def run(self, phase, function, *args):
+        gc.collect()
+        if tracemalloc:
+            tracemalloc.start()
+        start = default_timer()
+        result = function(*args)
+        seconds = default_timer() - start
+        peak = None
+        if tracemalloc:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        if phase not in self.results:
+            self.phases.append(phase)
+            self.results[phase] = [0.0, 0]
+        self.results[phase][0] += seconds
+        self.results[phase][1] = max(self.results[phase][1], peak or 0)
+        return result
+
+    def report(self, title):
+        lines = [title + '\n']
+        for phase in self.phases:
+            seconds, peak = self.results[phase]
+            if tracemalloc:
+                lines.append('  %-18s %10.2f ms %10.1f kB\n' % (phase, seconds * 1000, peak / 1024.0))
+            else:
+                lines.append('  %-18s %10.2f ms\n' % (phase, seconds * 1000))
+        total = sum(r[0] for r in self.results.values())
+        lines.append('  %-18s %10.2f ms\n' % ('total', total * 1000))
+        return ''.join(lines)
+
+def generator_options(workdir):
+    options, dummy = gen.optparser.parse_args(['-T', '-q', '-I', workdir])
+    return options
+
+def measure_files(files, options):
+    '''files is a list of (filename, fdesc) in dependency order.
+    The last file is the one generated, others are its dependencies.'''
+    m = Measurement()
+    parsed = {}
+    for filename, fdesc in files[:-1]:
+        parsed[fdesc.name] = m.run('parse_file', gen.parse_file, filename, fdesc, options)
+
+    filename, fdesc = files[-1]
+    f = m.run('parse_file', gen.parse_file, filename, fdesc, options)
+
+    def link():
+        for dep in f.fdesc.dependency:
+            if dep in parsed:
+                f.add_dependency(parsed[dep])
+    m.run('add_dependency', link)
+    m.run('sort_dependencies', f.sorted_messages)
+    m.run('encoded_size', f.message_sizes)
+
+    headername = os.path.splitext(os.path.basename(filename))[0] + '.pb.h'
+    includes = list(f.fdesc.dependency)
+    m.run('generate_header', lambda: ''.join(f.generate_header(includes, headername, options)))
+    m.run('generate_source', lambda: ''.join(f.generate_source(headername, options)))
+    return m
+
+def run_schema(schema, workdir):
+    options = generator_options(workdir)
+    common = make_common_file(schema)
+    total = Measurement()
+    for i in range(schema.files):
+        fdesc, options_lines = make_file(schema, i)
+        with open(os.path.join(workdir, 'bench%d.options' % i), 'w') as f:
+            f.write('\n'.join(options_lines) + '\n')
+
+        m = measure_files([(common.name, common), (fdesc.name, fdesc)], options)
+        for phase in m.phases:
+            if phase not in total.results:
+                total.phases.append(phase)
+                total.results[phase] = [0.0, 0]
+            total.results[phase][0] += m.results[phase][0]
+            total.results[phase][1] = max(total.results[phase][1], m.results[phase][1])
+    return total
+
+def run_dfu(dfudir, workdir):
+    '''Measure the real DFU init packet schema. Returns None if protoc is
+    not available to compile it.'''
+    pbfile = os.path.join(workdir, 'dfu-cc.pb')
+    try:
+        subprocess.check_call(['protoc', '-I' + dfudir, '-o' + pbfile,
+                               os.path.join(dfudir, 'dfu-cc.proto')])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    shutil.copy(os.path.join(dfudir, 'dfu-cc.options'), workdir)
+    data = open(pbfile, 'rb').read()
+    fdesc = descriptor.FileDescriptorSet.FromString(data).file[0]
+    return measure_files([('dfu-cc.proto', fdesc)], generator_options(workdir))
+
+# ---------------------------------------------------------------------------
+#                         Command line interface
+# ---------------------------------------------------------------------------
+
+default_dfudir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', '..', '..', 'components', 'libraries',
+                              'bootloader', 'dfu')
+
+optparser = OptionParser(
+    usage = "Usage: nanopb_benchmark.py [options]",
+    epilog = "Reports time and peak memory (Python 3 only) of each generator phase.")
+optparser.add_option("-m", "--messages", dest="messages", type="int", default=100,
+    help="Top level messages per file. [default: %default]")
+optparser.add_option("-d", "--depth", dest="depth", type="int", default=2,
+    help="Nesting depth of messages. [default: %default]")
+optparser.add_option("-f", "--fields", dest="fields", type="int", default=10,
+    help="Fields per message. [default: %default]")
+optparser.add_option("-e", "--enums", dest="enums", type="int", default=4,
+    help="Number of shared enums. [default: %default]")
+optparser.add_option("-n", "--enum-values", dest="enum_values", type="int", default=16,
+    help="Values per enum. [default: %default]")
+optparser.add_option("-o", "--oneofs", dest="oneofs", type="int", default=1,
+    help="Oneofs per message. [default: %default]")
+optparser.add_option("-l", "--options-lines", dest="options_lines", type="int", default=0,
+    help="Minimum number of lines in each .options file. [default: %default]")
+optparser.add_option("-F", "--files", dest="files", type="int", default=1,
+    help="Number of files importing the shared enums. [default: %default]")
+optparser.add_option("-r", "--reverse", dest="reverse", action="store_true", default=False,
+    help="Declare each message before the message it contains, instead of after it.")
+optparser.add_option("-s", "--scale", dest="scale", type="int", default=0, metavar="STEPS",
+    help="Also run STEPS more times, doubling the message count each time.")
+optparser.add_option("--dfu-dir", dest="dfudir", metavar="DIR", default=default_dfudir,
+    help="Directory containing dfu-cc.proto and dfu-cc.options.")
+optparser.add_option("--no-dfu", dest="dfu", action="store_false", default=True,
+    help="Skip the dfu-cc.proto benchmark.")
+
+def main():
+    options, args = optparser.parse_args()
+    workdir = tempfile.mkdtemp(prefix = 'nanopb_benchmark')
+    try:
+        if options.dfu:
+            m = run_dfu(options.dfudir, workdir)
+            if m is None:
+                sys.stdout.write('dfu-cc.proto: skipped, protoc not found\n\n')
+            else:
+                sys.stdout.write(m.report('dfu-cc.proto with dfu-cc.options') + '\n')
+
+        for step in range(options.scale + 1):
+            schema = Schema(options.messages * 2**step, options.depth, options.fields,
+                            options.enums, options.enum_values, options.oneofs,
+                            options.options_lines, options.files, options.reverse)
+            m = run_schema(schema, workdir)
+            sys.stdout.write(m.report(str(schema)) + '\n')
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
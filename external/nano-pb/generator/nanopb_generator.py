@@ -7,7 +7,6 @@ nanopb_version = "nanopb-0.3.6-dev"
 
 import sys
 import re
-from functools import reduce
 
 try:
     # Add some dummy imports to keep packaging tools happy.
@@ -41,6 +40,93 @@ except:
     ''' + '\n')
     raise
 
+# ---------------------------------------------------------------------------
+#                     Profiling of generator phases
+# ---------------------------------------------------------------------------
+
+from contextlib import contextmanager
+from timeit import default_timer
+
+class PhaseTimer(object):
+    '''Accumulates the time spent in each phase of the generator, for the
+    --profile option. Phases can be nested, and time spent in an inner
+    phase is not counted for the outer one. Does nothing unless enabled.'''
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.order = []
+        self.stack = []
+        self.started = None
+
+    def add(self, phase, seconds):
+        if phase not in self.totals:
+            self.totals[phase] = 0.0
+            self.order.append(phase)
+        self.totals[phase] += seconds
+
+    def merge(self, totals):
+        '''Add the totals collected by another PhaseTimer, e.g. in a worker process.'''
+        for phase in sorted(totals):
+            self.add(phase, totals[phase])
+
+    def start(self, phase):
+        now = default_timer()
+        if self.stack:
+            self.add(self.stack[-1], now - self.started)
+        self.stack.append(phase)
+        self.started = now
+
+    def stop(self):
+        now = default_timer()
+        self.add(self.stack.pop(), now - self.started)
+        self.started = now
+
+    @contextmanager
+    def phase(self, phase):
+        if not self.enabled:
+            yield
+            return
+
+        self.start(phase)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def timed(self, phase, fragments):
+        '''Wrap an iterable, counting the time spent producing each item.'''
+        if not self.enabled:
+            for fragment in fragments:
+                yield fragment
+            return
+
+        iterator = iter(fragments)
+        while True:
+            self.start(phase)
+            try:
+                fragment = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.stop()
+            yield fragment
+
+    def report(self):
+        '''Return a table of the time spent in each phase.'''
+        total = sum(self.totals.values())
+        lines = ['Generator profile:\n']
+        for phase in self.order:
+            seconds = self.totals[phase]
+            lines.append('  %-20s %9.3f ms %5.1f %%\n' % (phase, seconds * 1000,
+                         100.0 * seconds / total if total else 0.0))
+        lines.append('  %-20s %9.3f ms\n' % ('total', total * 1000))
+        return ''.join(lines)
+
+profiler = PhaseTimer()
+
 # ---------------------------------------------------------------------------
 #                     Generation of single fields
 # ---------------------------------------------------------------------------
@@ -82,16 +168,32 @@ except NameError:
 
 from camel_case_splitter import split_camel_case
 
-class Names:
-    '''Keeps a set of nested names and formats them to C identifier.'''
+class Names(object):
+    '''Keeps a set of nested names and formats them to C identifier.
+    Names are immutable and hashable, and the C identifier is only
+    formatted once, on first use.'''
+    __slots__ = ('parts', 'identifier')
+
     def __init__(self, parts = ()):
         if isinstance(parts, Names):
             parts = parts.parts
-        self.parts = tuple(parts)
+        object.__setattr__(self, 'parts', tuple(parts))
+        object.__setattr__(self, 'identifier', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Names objects are immutable")
+
+    def __reduce__(self):
+        return (Names, (self.parts,))
 
     def __str__(self):
-        name_str = '_'.join(self.parts)
-        return split_camel_case(name_str)
+        if self.identifier is None:
+            name_str = '_'.join(self.parts)
+            object.__setattr__(self, 'identifier', split_camel_case(name_str))
+        return self.identifier
+
+    def __repr__(self):
+        return 'Names(%r)' % (self.parts,)
 
     def __add__(self, other):
         if isinstance(other, strtypes):
@@ -104,6 +206,12 @@ class Names:
     def __eq__(self, other):
         return isinstance(other, Names) and self.parts == other.parts
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.parts)
+
 def names_from_type_name(type_name):
     '''Parse Names() from FieldDescriptorProto type_name'''
     if type_name[0] != '.':
@@ -166,6 +274,48 @@ class EncodedSize:
         else:
             return 2**32 - 1
 
+class EncodedSizeResolver:
+    '''Computes the encoded sizes of messages during a single generator run.
+    Each message is sized once, its submessages first, and the result is
+    cached. Works as a drop-in replacement for the dependencies dict.'''
+    def __init__(self, dependencies):
+        self.dependencies = dependencies
+        self.sizes = {}
+        self.stack = []
+
+    @staticmethod
+    def wrap(dependencies):
+        if isinstance(dependencies, EncodedSizeResolver):
+            return dependencies
+        return EncodedSizeResolver(dependencies)
+
+    def __contains__(self, name):
+        return name in self.dependencies
+
+    def __getitem__(self, name):
+        return self.dependencies[name]
+
+    def message_size(self, msg):
+        '''Return the cached encoded size of msg, computing it if needed.'''
+        name = str(msg.name)
+        if name in self.sizes:
+            return self.sizes[name]
+
+        if name in self.stack:
+            cycle = self.stack[self.stack.index(name):] + [name]
+            raise Exception("Message %s contains itself through static fields: %s. "
+                            "Use FT_POINTER or FT_CALLBACK to break the cycle."
+                            % (name, ' -> '.join(cycle)))
+
+        self.stack.append(name)
+        try:
+            size = msg.fields_encoded_size(self)
+        finally:
+            self.stack.pop()
+
+        self.sizes[name] = size
+        return size
+
 class Enum:
     def __init__(self, names, desc, enum_options):
         '''desc is EnumDescriptorProto'''
@@ -183,6 +333,11 @@ class Enum:
         self.value_longnames = [str(self.names + x.name).upper() for x in desc.value]
         self.packed = enum_options.packed_enum
 
+        # Maps the long name of each value to the name used in the enum
+        self.values_by_longname = {}
+        for longname, value in zip(self.value_longnames, self.values):
+            self.values_by_longname.setdefault(longname, value[0])
+
     def has_negative(self):
         for n, v in self.values:
             if v < 0:
@@ -194,26 +349,26 @@ class Enum:
 
     def __str__(self):
         # result = 'typedef enum _%s {\n' % self.names_t
-        result = 'typedef enum\n{\n'
-        result += ',\n'.join(["    %s = %d" % x for x in self.values])
-        result += '\n}'
+        result = ['typedef enum\n{\n']
+        result.append(',\n'.join(["    %s = %d" % x for x in self.values]))
+        result.append('\n}')
 
         if self.packed:
-            result += ' pb_packed'
+            result.append(' pb_packed')
 
-        result += ' %s;' % self.names_t
+        result.append(' %s;' % self.names_t)
 
-        result += '\n#define %s_MIN %s' % (self.names_upper, self.values[0][0])
-        result += '\n#define %s_MAX %s' % (self.names_upper, self.values[-1][0])
-        result += '\n#define %s_ARRAYSIZE ((%s)(%s+1))' % (self.names_upper, str(self.names_t), self.values[-1][0])
+        result.append('\n#define %s_MIN %s' % (self.names_upper, self.values[0][0]))
+        result.append('\n#define %s_MAX %s' % (self.names_upper, self.values[-1][0]))
+        result.append('\n#define %s_ARRAYSIZE ((%s)(%s+1))' % (self.names_upper, str(self.names_t), self.values[-1][0]))
 
         if not self.options.long_names:
             # Define the long names always so that enum value references
             # from other files work properly.
             for i, x in enumerate(self.values):
-                result += '\n#define %s %s' % (self.value_longnames[i], x[0])
+                result.append('\n#define %s %s' % (self.value_longnames[i], x[0]))
 
-        return result
+        return ''.join(result)
 
 class FieldMaxSize:
     def __init__(self, worst = 0, checks = [], field_name = 'undefined'):
@@ -223,7 +378,7 @@ class FieldMaxSize:
             self.worst = worst
 
         self.worst_field = field_name
-        self.checks = checks
+        self.checks = list(checks)
 
     def extend(self, extend, field_name = None):
         self.worst = max(self.worst, extend.worst)
@@ -770,7 +925,7 @@ class OneOf(Field):
 
 
 class Message:
-    def __init__(self, names, desc, message_options):
+    def __init__(self, names, desc, message_options, context):
         self.name = names
         self.name_t = self.name + "_t"
         self.fields = []
@@ -782,7 +937,7 @@ class Message:
 
         if hasattr(desc, 'oneof_decl'):
             for i, f in enumerate(desc.oneof_decl):
-                oneof_options = get_nanopb_suboptions(desc, message_options, self.name + f.name)
+                oneof_options = get_nanopb_suboptions(desc, message_options, self.name + f.name, context)
                 if oneof_options.no_unions:
                     no_unions.append(i) # No union, but add fields normally
                 elif oneof_options.type == nanopb_pb2.FT_IGNORE:
@@ -795,7 +950,7 @@ class Message:
                     self.fields.append(oneof)
 
         for f in desc.field:
-            field_options = get_nanopb_suboptions(f, message_options, self.name + f.name)
+            field_options = get_nanopb_suboptions(f, message_options, self.name + f.name, context)
             if field_options.type == nanopb_pb2.FT_IGNORE:
                 continue
 
@@ -809,7 +964,7 @@ class Message:
                 self.fields.append(field)
 
         if len(desc.extension_range) > 0:
-            field_options = get_nanopb_suboptions(desc, message_options, self.name + 'extensions')
+            field_options = get_nanopb_suboptions(desc, message_options, self.name + 'extensions', context)
             range_start = min([r.start for r in desc.extension_range])
             if field_options.type != nanopb_pb2.FT_IGNORE:
                 self.fields.append(ExtensionRange(self.name, range_start, field_options))
@@ -826,27 +981,30 @@ class Message:
         return deps
 
     def __str__(self):
-        # result = 'typedef struct _%s {\n' % self.name_t
-        result = 'typedef struct {\n'
+        result = []
+        if self.packed:
+            result.append('PB_PACKED_STRUCT_START\n')
+
+        # result.append('typedef struct _%s {\n' % self.name_t)
+        result.append('typedef struct {\n')
 
         if not self.ordered_fields:
             # Empty structs are not allowed in C standard.
             # Therefore add a dummy field if an empty message occurs.
-            result += '    char dummy_field;'
-        result += '\n'.join([str(f) for f in self.ordered_fields])
-        result += '\n/* @@protoc_insertion_point(struct:%s) */' % self.name_t
-        result += '\n}'
+            result.append('    char dummy_field;')
+        result.append('\n'.join([str(f) for f in self.ordered_fields]))
+        result.append('\n/* @@protoc_insertion_point(struct:%s) */' % self.name_t)
+        result.append('\n}')
 
         if self.packed:
-            result += ' pb_packed'
+            result.append(' pb_packed')
 
-        result += ' %s;' % self.name_t
+        result.append(' %s;' % self.name_t)
 
         if self.packed:
-            result = 'PB_PACKED_STRUCT_START\n' + result
-            result += '\nPB_PACKED_STRUCT_END'
+            result.append('\nPB_PACKED_STRUCT_END')
 
-        return result
+        return ''.join(result)
 
     def types(self):
         return ''.join([f.types() for f in self.fields])
@@ -857,26 +1015,20 @@ class Message:
 
         parts = []
         for field in self.ordered_fields:
-            to_append = ''
             for i in field.get_initializer(null_init).split(', '):
                 if 'init_default' in i or 'init_zero' in i:
-                    to_append += i.upper()
+                    parts.append(i.upper())
                 else:
-                    to_append += i
-                to_append += ", "
-
-            to_append = to_append[:-2]
-
-            parts.append(to_append)
+                    parts.append(i)
         return '{' + ', '.join(parts) + '}'
 
     def default_decl(self, declaration_only = False):
-        result = ""
+        result = []
         for field in self.fields:
             default = field.default_decl(declaration_only)
             if default is not None:
-                result += default + '\n'
-        return result
+                result.append(default + '\n')
+        return ''.join(result)
 
     def count_required_fields(self):
         '''Returns number of required fields inside this message'''
@@ -901,21 +1053,27 @@ class Message:
         return result
 
     def fields_definition(self):
-        result = 'const pb_field_t %s_fields[%d] = {\n' % (self.name, self.count_all_fields() + 1)
+        result = ['const pb_field_t %s_fields[%d] = {\n' % (self.name, self.count_all_fields() + 1)]
 
         prev = None
         for field in self.ordered_fields:
-            result += field.pb_field_t(prev)
-            result += ',\n'
+            result.append(field.pb_field_t(prev))
+            result.append(',\n')
             prev = field.get_last_field_name()
 
-        result += '    PB_LAST_FIELD\n};'
-        return result
+        result.append('    PB_LAST_FIELD\n};')
+        return ''.join(result)
 
     def encoded_size(self, dependencies):
         '''Return the maximum size that this message can take when encoded.
         If the size cannot be determined, returns None.
+        dependencies is either a dict or an EncodedSizeResolver, the latter
+        caching the sizes of all messages visited.
         '''
+        return EncodedSizeResolver.wrap(dependencies).message_size(self)
+
+    def fields_encoded_size(self, dependencies):
+        '''Sum of the encoded sizes of all fields, uncached.'''
         size = EncodedSize(0)
         for field in self.fields:
             fsize = field.encoded_size(dependencies)
@@ -956,23 +1114,51 @@ def iterate_extensions(desc, names = Names()):
             yield subname, extension
 
 def toposort2(data):
-    '''Topological sort.
-    From http://code.activestate.com/recipes/577413-topological-sort/
-    This function is under the MIT license.
+    '''Topological sort of data, a dict of {item: set of items it depends on}.
+    Items are yielded in rounds: first those without dependencies, then those
+    depending only on the first round and so on, each round in sorted order.
+    Runs in linear time (plus the final sort) and raises an exception showing
+    the dependency loop if one exists.
     '''
-    for k, v in list(data.items()):
-        v.discard(k) # Ignore self dependencies
-    extra_items_in_deps = reduce(set.union, list(data.values()), set()) - set(data.keys())
-    data.update(dict([(item, set()) for item in extra_items_in_deps]))
-    while True:
-        ordered = set(item for item,dep in list(data.items()) if not dep)
-        if not ordered:
-            break
-        for item in sorted(ordered):
-            yield item
-        data = dict([(item, (dep - ordered)) for item,dep in list(data.items())
-                if item not in ordered])
-    assert not data, "A cyclic dependency exists amongst %r" % data
+    # Ignore self dependencies, and add items that only appear as dependencies
+    deps = dict((item, set(dep) - set([item])) for item, dep in data.items())
+    for dep in list(deps.values()):
+        for item in dep:
+            deps.setdefault(item, set())
+
+    dependents = dict((item, []) for item in deps)
+    remaining = {}
+    for item, dep in deps.items():
+        remaining[item] = len(dep)
+        for d in dep:
+            dependents[d].append(item)
+
+    # Kahn's algorithm, recording the round in which each item becomes free
+    queue = [item for item in deps if not remaining[item]]
+    rounds = {}
+    for item in queue:
+        rounds[item] = max([rounds[d] + 1 for d in deps[item]] or [0])
+        for dependent in dependents[item]:
+            remaining[dependent] -= 1
+            if not remaining[dependent]:
+                queue.append(dependent)
+
+    if len(queue) < len(deps):
+        # Every blocked item depends on another blocked item, so following
+        # those dependencies must end up in a loop.
+        blocked = set(item for item in deps if remaining[item])
+        path = [min(blocked)]
+        visited = {}
+        while path[-1] not in visited:
+            visited[path[-1]] = len(path) - 1
+            path.append(min(d for d in deps[path[-1]] if d in blocked))
+        cycle = path[visited[path[-1]]:]
+        raise Exception("Cyclic dependency between messages: %s. "
+                        "Use FT_POINTER or FT_CALLBACK to break the cycle."
+                        % ' -> '.join(cycle))
+
+    for item in sorted(queue, key = lambda item: (rounds[item], item)):
+        yield item
 
 def sort_dependencies(messages):
     '''Sort a list of Messages based on dependencies.'''
@@ -997,10 +1183,12 @@ def make_identifier(headername):
     return result
 
 class ProtoFile:
-    def __init__(self, fdesc, file_options):
-        '''Takes a FileDescriptorProto and parses it.'''
+    def __init__(self, fdesc, file_options, context):
+        '''Takes a FileDescriptorProto and parses it.
+        context is the GeneratorContext holding the .options file state.'''
         self.fdesc = fdesc
         self.file_options = file_options
+        self.context = context
         self.dependencies = {}
         self.parse()
 
@@ -1012,6 +1200,8 @@ class ProtoFile:
         self.enums = []
         self.messages = []
         self.extensions = []
+        self.message_order = None
+        self.size_resolver = None
 
         if self.fdesc.package:
             base_name = Names(self.fdesc.package.split('.'))
@@ -1019,48 +1209,85 @@ class ProtoFile:
             base_name = Names()
 
         for enum in self.fdesc.enum_type:
-            enum_options = get_nanopb_suboptions(enum, self.file_options, base_name + enum.name)
+            enum_options = get_nanopb_suboptions(enum, self.file_options, base_name + enum.name, self.context)
             self.enums.append(Enum(base_name, enum, enum_options))
 
         for names, message in iterate_messages(self.fdesc, base_name):
-            message_options = get_nanopb_suboptions(message, self.file_options, names)
+            message_options = get_nanopb_suboptions(message, self.file_options, names, self.context)
 
             if message_options.skip_message:
                 continue
 
-            self.messages.append(Message(names, message, message_options))
+            self.messages.append(Message(names, message, message_options, self.context))
             for enum in message.enum_type:
-                enum_options = get_nanopb_suboptions(enum, message_options, names + enum.name)
+                enum_options = get_nanopb_suboptions(enum, message_options, names + enum.name, self.context)
                 self.enums.append(Enum(names, enum, enum_options))
 
         for names, extension in iterate_extensions(self.fdesc, base_name):
-            field_options = get_nanopb_suboptions(extension, self.file_options, names + extension.name)
+            field_options = get_nanopb_suboptions(extension, self.file_options, names + extension.name, self.context)
             if field_options.type != nanopb_pb2.FT_IGNORE:
                 self.extensions.append(ExtensionField(names, extension, field_options))
 
+        # Index the fields that add_dependency() may have to fix up
+        self.default_fields = []
+        self.enum_fields = {}
+        for message in self.messages:
+            for field in message.fields:
+                if field.default is not None:
+                    self.default_fields.append(field)
+                if field.pbtype == 'ENUM':
+                    self.enum_fields.setdefault(field.ctype, []).append(field)
+
+    def sorted_messages(self):
+        '''Return the messages sorted by their dependencies, so that each
+        struct is defined before it is used. Computed only once.'''
+        if self.message_order is None:
+            with profiler.phase('sort_dependencies'):
+                self.message_order = list(sort_dependencies(self.messages))
+        return self.message_order
+
+    def message_sizes(self):
+        '''Return an EncodedSizeResolver holding the encoded sizes of all
+        messages in this file. Computed once, after the last add_dependency().
+        Messages are sized in dependency order, so that each one only looks
+        up the already cached sizes of its submessages instead of recursing
+        through the whole chain.'''
+        if self.size_resolver is None:
+            messages = self.sorted_messages()
+            with profiler.phase('encoded_size'):
+                self.size_resolver = EncodedSizeResolver(self.dependencies)
+                for msg in messages:
+                    msg.encoded_size(self.size_resolver)
+        return self.size_resolver
+
     def add_dependency(self, other):
-        for enum in other.enums:
-            self.dependencies[str(enum.names)] = enum
-
-        for msg in other.messages:
-            self.dependencies[str(msg.name)] = msg
-
-        # Fix field default values where enum short names are used.
-        for enum in other.enums:
-            if not enum.options.long_names:
-                for message in self.messages:
-                    for field in message.fields:
-                        if field.default in enum.value_longnames:
-                            idx = enum.value_longnames.index(field.default)
-                            field.default = enum.values[idx][0]
-
-        # Fix field data types where enums have negative values.
-        for enum in other.enums:
-            if not enum.has_negative():
-                for message in self.messages:
-                    for field in message.fields:
-                        if field.pbtype == 'ENUM' and field.ctype == enum.names:
-                            field.pbtype = 'UENUM'
+        with profiler.phase('add_dependency'):
+            # New types may change the sizes of our messages
+            self.size_resolver = None
+
+            for enum in other.enums:
+                self.dependencies[str(enum.names)] = enum
+
+            for msg in other.messages:
+                self.dependencies[str(msg.name)] = msg
+
+            # Fix field default values where enum short names are used.
+            shortnames = {}
+            for enum in other.enums:
+                if not enum.options.long_names:
+                    for longname, shortname in enum.values_by_longname.items():
+                        shortnames.setdefault(longname, shortname)
+
+            if shortnames:
+                for field in self.default_fields:
+                    if field.default in shortnames:
+                        field.default = shortnames[field.default]
+
+            # Fix field data types where enums have negative values.
+            for enum in other.enums:
+                if not enum.has_negative():
+                    for field in self.enum_fields.get(enum.names, []):
+                        field.pbtype = 'UENUM'
 
     def generate_header(self, includes, headername, options):
         '''Generate content for a header file.
@@ -1106,7 +1333,7 @@ class ProtoFile:
 
         if self.messages:
             yield '/* Struct definitions */\n'
-            for msg in sort_dependencies(self.messages):
+            for msg in self.sorted_messages():
                 yield msg.types()
                 yield str(msg) + '\n\n'
 
@@ -1132,7 +1359,7 @@ class ProtoFile:
             yield '\n'
 
             yield '/* Field tags (for use in manual encoding/decoding) */\n'
-            for msg in sort_dependencies(self.messages):
+            for msg in self.sorted_messages():
                 for field in msg.fields:
                     yield field.tags()
             for extension in self.extensions:
@@ -1145,8 +1372,9 @@ class ProtoFile:
             yield '\n'
 
             yield '/* Maximum encoded size of messages (where known) */\n'
+            sizes = self.message_sizes()
             for msg in self.messages:
-                msize = msg.encoded_size(self.dependencies)
+                msize = msg.encoded_size(sizes)
                 identifier = ('%s_size' % msg.name).upper()
                 if msize is not None:
                     yield '#define %-40s %s\n' % (identifier, str(msize).upper())
@@ -1167,7 +1395,7 @@ class ProtoFile:
 
             for msg in self.messages:
                 m = "-1"
-                msize = msg.encoded_size(self.dependencies)
+                msize = msg.encoded_size(sizes)
                 if msize is not None:
                     m = msize
                 if hasattr(msg,'msgid'):
@@ -1298,12 +1526,19 @@ class ProtoFile:
 #                    Options parsing for the .proto files
 # ---------------------------------------------------------------------------
 
-from fnmatch import fnmatch
+import fnmatch
 
-def read_options_file(infile):
+def read_options_file(infile, errors = None):
     '''Parse a separate options file to list:
         [(namemask, options), ...]
+    Messages about invalid lines are appended to the list errors, or
+    written to stderr if it is not given.
     '''
+    if errors is None:
+        report = sys.stderr.write
+    else:
+        report = errors.append
+
     results = []
     data = infile.read()
     data = re.sub('/\*.*?\*/', '', data, flags = re.MULTILINE)
@@ -1317,9 +1552,9 @@ def read_options_file(infile):
         parts = line.split(None, 1)
 
         if len(parts) < 2:
-            sys.stderr.write("%s:%d: " % (infile.name, i + 1) +
-                             "Option lines should have space between field name and options. " +
-                             "Skipping line: '%s'\n" % line)
+            report("%s:%d: " % (infile.name, i + 1) +
+                   "Option lines should have space between field name and options. " +
+                   "Skipping line: '%s'\n" % line)
             continue
 
         opts = nanopb_pb2.NanoPBOptions()
@@ -1327,31 +1562,79 @@ def read_options_file(infile):
         try:
             text_format.Merge(parts[1], opts)
         except Exception as e:
-            sys.stderr.write("%s:%d: " % (infile.name, i + 1) +
-                             "Unparseable option line: '%s'. " % line +
-                             "Error: %s\n" % str(e))
+            report("%s:%d: " % (infile.name, i + 1) +
+                   "Unparseable option line: '%s'. " % line +
+                   "Error: %s\n" % str(e))
             continue
         results.append((parts[0], opts))
 
     return results
 
-class Globals:
-    '''Ugly global variables, should find a good way to pass these.'''
-    verbose_options = False
-    separate_options = []
-    matched_namemasks = set()
-
-def get_nanopb_suboptions(subdesc, options, name):
+class OptionsIndex:
+    '''Lookup table for the (namemask, options) list of an .options file.
+    Masks without wildcards are looked up directly by name. The rest are
+    compiled once and grouped by the literal prefix before their first
+    wildcard, so that a name is only tested against the masks whose prefix
+    it starts with.
+    '''
+    def __init__(self, separate_options):
+        self.exact = {}
+        self.wildcards = {}
+        for i, (namemask, options) in enumerate(separate_options):
+            mask = os.path.normcase(namemask)
+            prefix = re.match(r'[^*?[]*', mask).group(0)
+            if prefix == mask:
+                self.exact.setdefault(mask, []).append((i, namemask, options))
+            else:
+                self.wildcards.setdefault(prefix, []).append(
+                    (i, namemask, options, re.compile(fnmatch.translate(mask))))
+
+        self.prefix_lengths = sorted(set(len(p) for p in self.wildcards))
+
+    def lookup(self, dotname):
+        '''Return [(namemask, options), ...] matching dotname, in the order
+        they appear in the options file.'''
+        name = os.path.normcase(dotname)
+        matches = self.exact.get(name, [])
+
+        candidates = []
+        for length in self.prefix_lengths:
+            if length > len(name):
+                break
+            candidates.extend(self.wildcards.get(name[:length], ()))
+
+        if candidates:
+            matches = matches + [(i, n, o) for i, n, o, r in candidates
+                                 if r.match(name)]
+            matches.sort(key = lambda m: m[0])
+
+        return [(n, o) for i, n, o in matches]
+
+class GeneratorContext:
+    '''State used while generating a single file: the patterns from its
+    .options file, which of them have matched so far, and the errors found
+    while reading it. Keeping this out of module globals allows several
+    files to be generated in parallel.'''
+    def __init__(self, separate_options = [], verbose_options = False, errors = None):
+        self.verbose_options = verbose_options
+        self.separate_options = separate_options
+        self.errors = errors or []
+        self.options_index = OptionsIndex(separate_options)
+        self.matched_namemasks = set()
+
+    def unmatched_namemasks(self):
+        return [n for n,o in self.separate_options if n not in self.matched_namemasks]
+
+def get_nanopb_suboptions(subdesc, options, name, context):
     '''Get copy of options, and merge information from subdesc.'''
     new_options = nanopb_pb2.NanoPBOptions()
     new_options.CopyFrom(options)
 
     # Handle options defined in a separate file
     dotname = '.'.join(name.parts)
-    for namemask, options in Globals.separate_options:
-        if fnmatch(dotname, namemask):
-            Globals.matched_namemasks.add(namemask)
-            new_options.MergeFrom(options)
+    for namemask, options in context.options_index.lookup(dotname):
+        context.matched_namemasks.add(namemask)
+        new_options.MergeFrom(options)
 
     # Handle options defined in .proto
     if isinstance(subdesc.options, descriptor.FieldOptions):
@@ -1369,7 +1652,7 @@ def get_nanopb_suboptions(subdesc, options, name):
         ext = subdesc.options.Extensions[ext_type]
         new_options.MergeFrom(ext)
 
-    if Globals.verbose_options:
+    if context.verbose_options:
         sys.stderr.write("Options for " + dotname + ": ")
         sys.stderr.write(text_format.MessageToString(new_options) + "\n")
 
@@ -1414,18 +1697,17 @@ optparser.add_option("-v", "--verbose", dest="verbose", action="store_true", def
     help="Print more information.")
 optparser.add_option("-s", dest="settings", metavar="OPTION:VALUE", action="append", default=[],
     help="Set generator option (max_size, max_count etc.).")
-
-def parse_file(filename, fdesc, options):
-    '''Parse a single file. Returns a ProtoFile instance.'''
-    toplevel_options = nanopb_pb2.NanoPBOptions()
-    for s in options.settings:
-        text_format.Merge(s, toplevel_options)
-
-    if not fdesc:
-        data = open(filename, 'rb').read()
-        fdesc = descriptor.FileDescriptorSet.FromString(data).file[0]
-
-    # Check if there is a separate .options file
+optparser.add_option("--cache-dir", dest="cache_dir", metavar="DIR", default=None,
+    help="Reuse output stored in DIR when the .pb file, .options file and generator options are unchanged. Old entries are not removed automatically.")
+optparser.add_option("--profile", dest="profile", action="store_true", default=False,
+    help="Print the time spent in each phase of the generator to stderr.")
+optparser.add_option("-j", "--jobs", dest="jobs", metavar="N", type="int", default=1,
+    help="Generate up to N files in parallel processes. [default: %default]")
+
+def find_options_file(filename, options):
+    '''Locate the separate .options file for filename.
+    Returns a tuple (optfilename, found, had_abspath).
+    '''
     had_abspath = False
     try:
         optfilename = options.options_file % os.path.splitext(filename)[0]
@@ -1437,40 +1719,68 @@ def parse_file(filename, fdesc, options):
     paths = ['.'] + options.options_path
     for p in paths:
         if os.path.isfile(os.path.join(p, optfilename)):
-            optfilename = os.path.join(p, optfilename)
-            if options.verbose:
-                sys.stderr.write('Reading options from ' + optfilename + '\n')
-            Globals.separate_options = read_options_file(open(optfilename, "rU"))
-            break
+            return os.path.join(p, optfilename), True, had_abspath
+
+    return optfilename, False, had_abspath
+
+def parse_file(filename, fdesc, options):
+    '''Parse a single file. Returns a ProtoFile instance.'''
+    toplevel_options = nanopb_pb2.NanoPBOptions()
+    for s in options.settings:
+        text_format.Merge(s, toplevel_options)
+
+    if not fdesc:
+        with profiler.phase('read_descriptor'):
+            data = open(filename, 'rb').read()
+            fdesc = descriptor.FileDescriptorSet.FromString(data).file[0]
+
+    # Errors about the options file are returned with the generated files,
+    # so that they are also reported when the output is taken from a cache.
+    errors = []
+
+    # Check if there is a separate .options file
+    optfilename, found, had_abspath = find_options_file(filename, options)
+    if found:
+        if options.verbose:
+            sys.stderr.write('Reading options from ' + optfilename + '\n')
+        with profiler.phase('read_options'):
+            separate_options = read_options_file(open(optfilename, "r"), errors)
     else:
         # If we are given a full filename and it does not exist, give an error.
         # However, don't give error when we automatically look for .options file
         # with the same name as .proto.
         if options.verbose or had_abspath:
-            sys.stderr.write('Options file not found: ' + optfilename + '\n')
-        Globals.separate_options = []
+            errors.append('Options file not found: ' + optfilename + '\n')
+        separate_options = []
 
-    Globals.matched_namemasks = set()
+    with profiler.phase('read_options'):
+        context = GeneratorContext(separate_options, options.verbose, errors)
 
     # Parse the file
-    file_options = get_nanopb_suboptions(fdesc, toplevel_options, Names([filename]))
-    f = ProtoFile(fdesc, file_options)
+    with profiler.phase('parse'):
+        file_options = get_nanopb_suboptions(fdesc, toplevel_options, Names([filename]), context)
+        f = ProtoFile(fdesc, file_options, context)
     f.optfilename = optfilename
 
     return f
 
-def process_file(filename, fdesc, options, other_files = {}):
+def process_file(filename, fdesc, options, other_files = {}, streaming = False):
     '''Process a single file.
     filename: The full path to the .proto or .pb source file, as string.
     fdesc: The loaded FileDescriptorSet, or None to read from the input file.
     options: Command line options as they come from OptionsParser.
+    streaming: If True, headerdata and sourcedata are returned as iterables
+               of string fragments, generated lazily as they are consumed.
 
     Returns a dict:
         {'headername': Name of header file,
          'headerdata': Data for the .h header file,
          'sourcename': Name of the source code file,
-         'sourcedata': Data for the .c source code file
+         'sourcedata': Data for the .c source code file,
+         'errors': Errors in reading the .options file,
+         'warnings': The errors followed by warnings about the .options file
         }
+    Neither is written to stderr here, see write_warnings().
     '''
     f = parse_file(filename, fdesc, options)
 
@@ -1479,6 +1789,13 @@ def process_file(filename, fdesc, options, other_files = {}):
         if dep in other_files:
             f.add_dependency(other_files[dep])
 
+    return generate_files(f, filename, options, streaming)
+
+def generate_files(f, filename, options, streaming = False):
+    '''Generate the header and source for an already parsed ProtoFile.
+    Generating does not modify f, so this can be repeated.
+    Arguments and return value are as for process_file().
+    '''
     # Decide the file names
     noext = os.path.splitext(filename)[0]
     headername = noext + options.extension + '.h'
@@ -1490,24 +1807,235 @@ def process_file(filename, fdesc, options, other_files = {}):
     excludes = ['nanopb.proto', 'google/protobuf/descriptor.proto'] + options.exclude
     includes = [d for d in f.fdesc.dependency if d not in excludes]
 
-    headerdata = ''.join(f.generate_header(includes, headerbasename, options))
-    sourcedata = ''.join(f.generate_source(headerbasename, options))
+    headerdata = profiler.timed('generate_header', f.generate_header(includes, headerbasename, options))
+    sourcedata = profiler.timed('generate_source', f.generate_source(headerbasename, options))
+    if not streaming:
+        headerdata = ''.join(headerdata)
+        sourcedata = ''.join(sourcedata)
 
     # Check if there were any lines in .options that did not match a member
-    unmatched = [n for n,o in Globals.separate_options if n not in Globals.matched_namemasks]
-    if unmatched and not options.quiet:
-        sys.stderr.write("Following patterns in " + f.optfilename + " did not match any fields: "
-                         + ', '.join(unmatched) + "\n")
-        if not Globals.verbose_options:
-            sys.stderr.write("Use  protoc --nanopb-out=-v:.   to see a list of the field names.\n")
+    errors = ''.join(f.context.errors)
+    warnings = errors
+    unmatched = f.context.unmatched_namemasks()
+    if unmatched:
+        warnings += ("Following patterns in " + f.optfilename + " did not match any fields: "
+                     + ', '.join(unmatched) + "\n")
+        if not f.context.verbose_options:
+            warnings += "Use  protoc --nanopb-out=-v:.   to see a list of the field names.\n"
 
     return {'headername': headername, 'headerdata': headerdata,
-            'sourcename': sourcename, 'sourcedata': sourcedata}
+            'sourcename': sourcename, 'sourcedata': sourcedata,
+            'errors': errors, 'warnings': warnings}
 
-def main_cli():
-    '''Main function when invoked directly from the command line.'''
+def write_warnings(results, options):
+    '''Write the errors and warnings of process_file() results to stderr.
+    With -q, only the errors are written.'''
+    if options.quiet:
+        sys.stderr.write(results['errors'])
+    else:
+        sys.stderr.write(results['warnings'])
 
-    options, filenames = optparser.parse_args()
+def process_file_job(job, streaming = False):
+    '''Process a single file in a worker process.
+    job is a tuple (filename, fdesc, options, dependency fdescs). The
+    dependencies are parsed in the worker, as ProtoFile objects are not
+    shared between processes.
+    '''
+    filename, fdesc, options, dep_fdescs = job
+    if fdesc is None and options.cache_dir and not options.verbose:
+        return cached_process_file(filename, options)
+
+    other_files = {}
+    for dep in dep_fdescs:
+        other_files[dep.name] = parse_file(dep.name, dep, options)
+    return process_file(filename, fdesc, options, other_files, streaming)
+
+def process_pool_job(job):
+    '''Run process_file_job() in a pool worker. The phase timings of the
+    worker are returned in the results, for the parent to merge.'''
+    profiler.enabled = job[2].profile
+    profiler.reset()
+    results = dict(process_file_job(job))
+    if profiler.enabled:
+        results['profile'] = profiler.totals
+    return results
+
+def process_jobs(jobs, options):
+    '''Run process_file_job() for each job, in parallel if requested
+    with -j. Results are iterated in the same order as jobs, and their
+    warnings are written as they are iterated. When running serially, the
+    output is streamed, see process_file().'''
+    if options.jobs > 1 and len(jobs) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(options.jobs, len(jobs)))
+        try:
+            all_results = pool.map(process_pool_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        for results in all_results:
+            profiler.merge(results.pop('profile', {}))
+    else:
+        all_results = (process_file_job(job, True) for job in jobs)
+
+    return report_warnings(all_results, options)
+
+def report_warnings(all_results, options):
+    '''Write the warnings of each result to stderr as it is iterated,
+    before its files are written. Pool workers do not write them, so this
+    keeps them in input order.'''
+    for results in all_results:
+        write_warnings(results, options)
+        yield results
+
+# ---------------------------------------------------------------------------
+#                       Caching of generated output
+# ---------------------------------------------------------------------------
+
+import hashlib
+import json
+import filecmp
+
+def replace_file(src, dst):
+    '''Rename src to dst, overwriting dst if it exists.'''
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2 has no os.replace()
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+def join_fragments(data):
+    '''Return data as a single string, whether it is one already or an
+    iterable of string fragments.'''
+    if isinstance(data, strtypes):
+        return data
+    return ''.join(data)
+
+def generator_sources_digest():
+    '''Return a hash of the source code of the generator modules, as it is
+    on disk now. Besides this file, the output depends on the name splitting
+    and on the nanopb options schema compiled into nanopb_pb2. Returns None
+    if the sources are not available, e.g. in a frozen executable.'''
+    modules = [__file__, sys.modules[split_camel_case.__module__].__file__,
+               nanopb_pb2.__file__]
+    h = hashlib.sha256()
+    try:
+        for path in modules:
+            # __file__ can be a .pyc on Python 2, the .py next to it is the source
+            data = open(os.path.splitext(path)[0] + '.py', 'rb').read()
+            h.update(('%d:' % len(data)).encode('ascii'))
+            h.update(data)
+    except (IOError, OSError):
+        return None
+    return h.hexdigest()
+
+# The code that is actually running, which is what the output depends on.
+# A long running process, such as nanopb_server.py, can compare this with
+# generator_sources_digest() to notice that the files have been updated.
+loaded_sources_digest = generator_sources_digest()
+
+def generation_key(filename, data, options):
+    '''Hash the descriptor data, the .options file contents, the generator
+    settings and version into a hex string. Any change in the inputs that
+    affects the output of process_file() gives a different key.'''
+    optfilename, found, had_abspath = find_options_file(filename, options)
+    if found:
+        optdata = open(optfilename, 'rb').read()
+    else:
+        optdata = None
+
+    parts = [nanopb_version, repr(loaded_sources_digest), filename, data,
+             repr(optdata), repr(options.settings), options.extension,
+             repr(options.exclude), options.genformat, options.libformat,
+             repr(options.notimestamp)]
+
+    h = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = part.encode('utf-8')
+        h.update(('%d:' % len(part)).encode('ascii'))
+        h.update(part)
+    return h.hexdigest()
+
+class GenerationCache:
+    '''On-disk store of process_file() results, keyed by generation_key().
+    Entries are never removed: each change to a .pb file, its options or
+    the generator adds a new one and leaves the old one in place. Delete
+    the cache directory to reclaim the space.'''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def load(self, key):
+        '''Return the stored results for key, or None.'''
+        try:
+            with open(self.path(key), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def store(self, key, results):
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                pass # Created by another process meanwhile
+
+        # Write to a temporary file first, so that concurrent generator runs
+        # never see a partially written entry.
+        tmpname = self.path(key) + '.%d.tmp' % os.getpid()
+        with open(tmpname, 'w') as f:
+            json.dump(results, f)
+        replace_file(tmpname, self.path(key))
+
+def cached_process_file(filename, options):
+    '''Like process_file() for a .pb file on disk, but reuses the output
+    stored in options.cache_dir if none of the inputs have changed.'''
+    cache = GenerationCache(options.cache_dir)
+    data = open(filename, 'rb').read()
+    key = generation_key(filename, data, options)
+
+    results = cache.load(key)
+    if results is None:
+        fdesc = descriptor.FileDescriptorSet.FromString(data).file[0]
+        results = process_file(filename, fdesc, options)
+        cache.store(key, results)
+
+    return results
+
+def write_if_changed(path, data):
+    '''Write data to path, unless the file already has that content.
+    data is either a string or an iterable of string fragments, which are
+    streamed to a temporary file next to path. Leaving an unchanged file
+    alone keeps its mtime, so that make does not rebuild everything that
+    includes it. Returns True if the file was written.'''
+    if isinstance(data, strtypes):
+        data = [data]
+
+    tmpname = path + '.%d.tmp' % os.getpid()
+    try:
+        with open(tmpname, 'w') as f:
+            for fragment in data:
+                f.write(fragment)
+
+        if os.path.isfile(path) and filecmp.cmp(tmpname, path, shallow = False):
+            return False
+
+        replace_file(tmpname, path)
+        return True
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+def parse_cli_args(args = None):
+    '''Parse and check command line arguments, exiting on errors.
+    Returns (options, filenames).'''
+    options, filenames = optparser.parse_args(args)
 
     if not filenames:
         optparser.print_help()
@@ -1521,24 +2049,37 @@ def main_cli():
         sys.stderr.write("\noutput_dir does not exist: %s\n" % options.output_dir)
         sys.exit(1)
 
+    return options, filenames
 
-    Globals.verbose_options = options.verbose
-    for filename in filenames:
-        results = process_file(filename, None, options)
-
+def write_results(all_results, options):
+    '''Write the files from process_file() results to options.output_dir.'''
+    for results in all_results:
         base_dir = options.output_dir or ''
         to_write = [
             (os.path.join(base_dir, results['headername']), results['headerdata']),
             (os.path.join(base_dir, results['sourcename']), results['sourcedata']),
         ]
 
+        with profiler.phase('write'):
+            written = [path for path, data in to_write if write_if_changed(path, data)]
+
         if not options.quiet:
-            paths = " and ".join([x[0] for x in to_write])
-            sys.stderr.write("Writing to %s\n" % paths)
+            if written:
+                sys.stderr.write("Writing to %s\n" % " and ".join(written))
+            else:
+                sys.stderr.write("%s are up to date\n" % " and ".join([x[0] for x in to_write]))
+
+def main_cli():
+    '''Main function when invoked directly from the command line.'''
 
-        for path, data in to_write:
-            with open(path, 'w') as f:
-                f.write(data)
+    options, filenames = parse_cli_args()
+    profiler.enabled = options.profile
+
+    jobs = [(filename, None, options, []) for filename in filenames]
+    write_results(process_jobs(jobs, options), options)
+
+    if options.profile:
+        sys.stderr.write(profiler.report())
 
 def main_plugin():
     '''Main function when invoked as a protoc plugin.'''
@@ -1564,8 +2105,7 @@ def main_plugin():
     import shlex
     args = shlex.split(params)
     options, dummy = optparser.parse_args(args)
-
-    Globals.verbose_options = options.verbose
+    profiler.enabled = options.profile
 
     response = plugin_pb2.CodeGeneratorResponse()
 
@@ -1575,24 +2115,46 @@ def main_plugin():
     import os.path
     options.options_path.append(os.path.dirname(request.file_to_generate[0]))
 
-    # Process any include files first, in order to have them
-    # available as dependencies
-    other_files = {}
-    for fdesc in request.proto_file:
-        other_files[fdesc.name] = parse_file(fdesc.name, fdesc, options)
+    fdescs = dict((fdesc.name, fdesc) for fdesc in request.proto_file)
+    to_generate = [f for f in request.file_to_generate if f in fdescs]
 
-    for filename in request.file_to_generate:
+    # Errors in the .options files of generated files are reported with their
+    # results. Dependencies that are not generated have no results, so their
+    # errors are written here.
+    for fdesc in request.proto_file:
+        if fdesc.name not in to_generate:
+            optfilename, found, had_abspath = find_options_file(fdesc.name, options)
+            if found:
+                read_options_file(open(optfilename, "r"))
+
+    if options.jobs > 1 and len(to_generate) > 1:
+        # Each worker parses the direct dependencies of its own file
+        jobs = [(filename, fdescs[filename], options,
+                 [fdescs[d] for d in fdescs[filename].dependency if d in fdescs])
+                for filename in to_generate]
+        all_results = process_jobs(jobs, options)
+    else:
+        # Process any include files first, in order to have them
+        # available as dependencies
+        other_files = {}
         for fdesc in request.proto_file:
-            if fdesc.name == filename:
-                results = process_file(filename, fdesc, options, other_files)
+            other_files[fdesc.name] = parse_file(fdesc.name, fdesc, options)
+
+        all_results = report_warnings(
+            (process_file(filename, fdescs[filename], options, other_files, True)
+             for filename in to_generate), options)
+
+    for results in all_results:
+        f = response.file.add()
+        f.name = results['headername']
+        f.content = join_fragments(results['headerdata'])
 
-                f = response.file.add()
-                f.name = results['headername']
-                f.content = results['headerdata']
+        f = response.file.add()
+        f.name = results['sourcename']
+        f.content = join_fragments(results['sourcedata'])
 
-                f = response.file.add()
-                f.name = results['sourcename']
-                f.content = results['sourcedata']
+    if options.profile:
+        sys.stderr.write(profiler.report())
 
     io.open(sys.stdout.fileno(), "wb").write(response.SerializeToString())
 
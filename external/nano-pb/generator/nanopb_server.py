@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+
+from __future__ import unicode_literals
+
+'''Keep nanopb_generator.py loaded in a server process for fast regeneration.
+
+Start the server once, optionally watching files for changes:
+    nanopb_server.py --serve [--watch generator options file.pb ...]
+
+Then use this script in place of nanopb_generator.py:
+    nanopb_server.py [generator options] file.pb ...
+
+The client only uses the standard library and forwards its arguments to
+the server over a Unix socket, so it does not pay for importing protobuf.
+If no server is running, it runs the generator directly instead.
+
+The server exits when it notices that the generator sources have changed
+on disk, so that the output never comes from an outdated generator.
+'''
+
+import os
+import sys
+import json
+import stat
+import socket
+import tempfile
+import traceback
+from optparse import OptionParser
+
+try:
+    from StringIO import StringIO # Python 2, accepts both str and unicode
+except ImportError:
+    from io import StringIO
+
+# ---------------------------------------------------------------------------
+#                      Messages between client and server
+# ---------------------------------------------------------------------------
+
+def send_message(sock, message):
+    '''Send a dict as a single line of JSON.'''
+    sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+def recv_message(sock):
+    '''Receive a dict sent with send_message().'''
+    data = b''
+    while b'\n' not in data:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode('utf-8'))
+
+# ---------------------------------------------------------------------------
+#                                 Server
+# ---------------------------------------------------------------------------
+
+class FileState:
+    '''Generated output kept in memory by the server.'''
+    def __init__(self, key, results):
+        self.key = key
+        self.results = results
+
+class Watch:
+    '''Files given with --watch, and the generator arguments for them.'''
+    def __init__(self, cwd, args, options, filenames):
+        self.cwd = cwd
+        self.args = args
+        self.options = options
+        self.filenames = filenames
+        self.mtimes = {}
+
+class GeneratorServer:
+    def __init__(self, gen, socket_path, interval):
+        '''gen is the imported nanopb_generator module.'''
+        self.gen = gen
+        self.socket_path = socket_path
+        self.interval = interval
+        self.files = {}
+        self.watches = []
+        self.running = True
+
+    def parse_args(self, args):
+        '''Like nanopb_generator.parse_cli_args(), but rejects the options
+        that the server does not support.'''
+        options, filenames = self.gen.parse_cli_args(args)
+        if options.jobs > 1:
+            sys.exit('-j is not supported by nanopb_server.py, the server generates one file at a time.')
+        return options, filenames
+
+    def process(self, filename, options):
+        '''Like nanopb_generator.process_file(), but keeps the output in
+        memory, keyed by a hash of its inputs. Only a file whose descriptor,
+        .options file, settings or generator changed is generated again.
+        Like --cache-dir, this also reuses the timestamp of the output.'''
+        gen = self.gen
+        data = open(filename, 'rb').read()
+        key = gen.generation_key(filename, data, options)
+        path = os.path.abspath(filename)
+
+        state = self.files.get(path)
+        if state is not None and state.key == key and not options.verbose:
+            results = state.results
+        elif options.cache_dir and not options.verbose:
+            results = gen.cached_process_file(filename, options)
+        else:
+            fdesc = gen.descriptor.FileDescriptorSet.FromString(data).file[0]
+            results = gen.process_file(filename, fdesc, options)
+
+        self.files[path] = FileState(key, results)
+        gen.write_warnings(results, options)
+        return results
+
+    def run_request(self, cwd, args, only = None):
+        '''Run the generator as if invoked with args in directory cwd.
+        If only is given, generate just those of the files in args.
+        Returns (exit status, stdout, stderr).'''
+        gen = self.gen
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        old_cwd = os.getcwd()
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        status = 0
+        try:
+            os.chdir(cwd)
+            options, filenames = self.parse_args(args)
+            if only is not None:
+                filenames = [f for f in filenames if f in only]
+
+            gen.profiler.enabled = options.profile
+            gen.profiler.reset()
+            gen.write_results((self.process(f, options) for f in filenames), options)
+            if options.profile:
+                sys.stderr.write(gen.profiler.report())
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                status = e.code
+            elif e.code is not None:
+                sys.stderr.write('%s\n' % e.code)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            stdout, stderr = sys.stdout.getvalue(), sys.stderr.getvalue()
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+            os.chdir(old_cwd)
+
+        return status, stdout, stderr
+
+    def add_watch(self, args):
+        '''Regenerate the files in args whenever they or their .options
+        files change.'''
+        options, filenames = self.parse_args(args)
+        watch = Watch(os.getcwd(), args, options, filenames)
+        self.watches.append(watch)
+
+    def input_mtimes(self, watch):
+        '''Return {filename: mtimes of the file and its .options file}.'''
+        def mtime(path):
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                return None
+
+        old_cwd = os.getcwd()
+        os.chdir(watch.cwd)
+        try:
+            result = {}
+            for filename in watch.filenames:
+                optfilename, found, had_abspath = self.gen.find_options_file(filename, watch.options)
+                result[filename] = (mtime(filename), found and mtime(optfilename))
+            return result
+        finally:
+            os.chdir(old_cwd)
+
+    def generator_changed(self):
+        '''Check if the generator sources on disk differ from the ones this
+        server has loaded. If so, stop the server and return True.'''
+        if self.gen.generator_sources_digest() == self.gen.loaded_sources_digest:
+            return False
+
+        if self.running:
+            sys.stderr.write('The generator sources have changed, stopping the server\n')
+            self.running = False
+        return True
+
+    def poll(self):
+        '''Regenerate the watched files whose inputs changed.'''
+        if self.generator_changed():
+            return
+
+        for watch in self.watches:
+            mtimes = self.input_mtimes(watch)
+            changed = [f for f in watch.filenames
+                       if mtimes[f] != watch.mtimes.get(f) and mtimes[f][0] is not None]
+            watch.mtimes = mtimes
+            if changed:
+                status, stdout, stderr = self.run_request(watch.cwd, watch.args, changed)
+                sys.stdout.write(stdout)
+                sys.stderr.write(stderr)
+
+    def handle(self, conn):
+        try:
+            conn.settimeout(30)
+            request = recv_message(conn)
+            if request.get('stop'):
+                self.running = False
+                reply = {'status': 0, 'stdout': '', 'stderr': 'Server stopped\n'}
+            elif self.generator_changed():
+                reply = {'outdated': True}
+            else:
+                status, stdout, stderr = self.run_request(request['cwd'], request['args'])
+                reply = {'status': status, 'stdout': stdout, 'stderr': stderr}
+            send_message(conn, reply)
+        except (socket.error, ValueError, KeyError) as e:
+            sys.stderr.write('Bad request: %s\n' % e)
+        finally:
+            conn.close()
+
+    def listen(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077) # Only our own user may connect
+        try:
+            listener.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        listener.listen(5)
+        return listener
+
+    def serve_forever(self):
+        listener = self.listen()
+        if self.watches:
+            listener.settimeout(self.interval)
+        sys.stderr.write('Listening on %s\n' % self.socket_path)
+
+        try:
+            self.poll()
+            while self.running:
+                try:
+                    conn, addr = listener.accept()
+                except socket.timeout:
+                    self.poll()
+                    continue
+
+                conn.settimeout(None)
+                self.handle(conn)
+                self.poll()
+        finally:
+            listener.close()
+            os.remove(self.socket_path)
+
+def owned_by_user(st):
+    '''Check that the file with os.lstat() result st belongs to the
+    current user.'''
+    return not hasattr(os, 'getuid') or st.st_uid == os.getuid()
+
+def prepare_socket(socket_path):
+    '''Create the private directory of the default socket, and remove a
+    socket left over from a server that died. Returns an error message if
+    socket_path is in use or not safe to use, otherwise None.'''
+    directory = os.path.dirname(socket_path)
+    if socket_path == default_socket() and not os.environ.get('XDG_RUNTIME_DIR'):
+        if not os.path.isdir(directory):
+            os.mkdir(directory, 0o700)
+        st = os.lstat(directory)
+        if not stat.S_ISDIR(st.st_mode) or not owned_by_user(st) or st.st_mode & 0o077:
+            return '%s must be a directory that only you can access' % directory
+
+    try:
+        st = os.lstat(socket_path)
+    except OSError:
+        return None # Does not exist yet
+
+    if not stat.S_ISSOCK(st.st_mode):
+        return '%s exists and is not a socket' % socket_path
+    if not owned_by_user(st):
+        return '%s belongs to another user' % socket_path
+
+    sock = connect(socket_path)
+    if sock is not None:
+        sock.close()
+        return 'a server is already running there'
+
+    os.remove(socket_path)
+    return None
+
+def run_server(options, args):
+    error = prepare_socket(options.socket)
+    if error:
+        sys.stderr.write('Cannot listen on %s: %s\n' % (options.socket, error))
+        return 1
+
+    import nanopb_generator as gen
+
+    server = GeneratorServer(gen, options.socket, options.interval)
+    if options.watch:
+        server.add_watch(args)
+    elif args:
+        sys.stderr.write('Generator arguments are only used with --watch\n')
+        return 1
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+# ---------------------------------------------------------------------------
+#                                 Client
+# ---------------------------------------------------------------------------
+
+def connect(socket_path):
+    '''Return a socket connected to the server, or None if there is none.
+    A socket that belongs to another user is never connected to, since
+    that user could see and alter everything that is generated.'''
+    try:
+        if not owned_by_user(os.lstat(socket_path)):
+            sys.stderr.write('Ignoring %s, it belongs to another user\n' % socket_path)
+            return None
+    except OSError:
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def run_locally(args):
+    '''Run the generator in this process, when no server is available.'''
+    import nanopb_generator as gen
+    sys.argv = [gen.__file__] + args
+    gen.main_cli()
+    return 0
+
+def run_client(options, args):
+    sock = connect(options.socket)
+    if sock is None:
+        if options.stop:
+            sys.stderr.write('No server running at %s\n' % options.socket)
+            return 1
+        return run_locally(args)
+
+    try:
+        send_message(sock, {'cwd': os.getcwd(), 'args': args, 'stop': options.stop})
+        reply = recv_message(sock)
+    except (socket.error, ValueError):
+        # The server died before sending a complete reply
+        if options.stop:
+            sys.stderr.write('Lost connection to the server at %s\n' % options.socket)
+            return 1
+        sys.stderr.write('Lost connection to the server at %s, running the generator locally\n'
+                         % options.socket)
+        return run_locally(args)
+    finally:
+        sock.close()
+
+    if reply.get('outdated'):
+        sys.stderr.write('The server at %s was running an older generator and has stopped, '
+                         'running the generator locally\n' % options.socket)
+        return run_locally(args)
+
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    return reply['status']
+
+# ---------------------------------------------------------------------------
+#                         Command line interface
+# ---------------------------------------------------------------------------
+
+def default_socket():
+    '''The socket is placed in $XDG_RUNTIME_DIR, or otherwise in a directory
+    of its own in the temporary directory that only this user can access.'''
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'nanopb_server.sock')
+    elif hasattr(os, 'getuid'):
+        return os.path.join(tempfile.gettempdir(), 'nanopb_server-%d' % os.getuid(), 'server.sock')
+    else:
+        return os.path.join(tempfile.gettempdir(), 'nanopb_server', 'server.sock')
+
+optparser = OptionParser(
+    usage = "Usage: nanopb_server.py --serve [--watch generator options file.pb ...]\n" +
+            "       nanopb_server.py [generator options] file.pb ...",
+    epilog = "All other options are passed on to nanopb_generator.py.")
+optparser.add_option("--serve", dest="serve", action="store_true", default=False,
+    help="Run the server instead of a client.")
+optparser.add_option("--watch", dest="watch", action="store_true", default=False,
+    help="With --serve, regenerate the given files when they or their .options files change.")
+optparser.add_option("--interval", dest="interval", metavar="SECONDS", type="float", default=1.0,
+    help="How often watched files are checked. [default: %default]")
+optparser.add_option("--socket", dest="socket", metavar="PATH",
+    default=os.environ.get('NANOPB_SERVER_SOCKET', default_socket()),
+    help="Unix socket of the server. [default: %default]")
+optparser.add_option("--stop", dest="stop", action="store_true", default=False,
+    help="Ask a running server to exit.")
+
+# Options of this script, and whether they take a value
+own_options = {'-h': False, '--help': False, '--serve': False, '--watch': False,
+               '--stop': False, '--interval': True, '--socket': True}
+
+def split_args(argv):
+    '''Separate the options of this script from those for the generator.'''
+    own = []
+    rest = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        name = arg.split('=', 1)[0]
+        if name in own_options:
+            own.append(arg)
+            if own_options[name] and '=' not in arg and i + 1 < len(argv):
+                i += 1
+                own.append(argv[i])
+        else:
+            rest.append(arg)
+        i += 1
+    return own, rest
+
+def main():
+    own, args = split_args(sys.argv[1:])
+    options, dummy = optparser.parse_args(own)
+
+    if not hasattr(socket, 'AF_UNIX'):
+        sys.stderr.write('Unix sockets are not available on this platform.\n')
+        if options.serve or options.stop:
+            return 1
+        return run_locally(args)
+
+    if options.serve:
+        return run_server(options, args)
+    else:
+        return run_client(options, args)
+
+if __name__ == '__main__':
+    sys.exit(main())